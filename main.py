@@ -1,14 +1,21 @@
+import asyncio
+import logging
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional
-
-from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from datetime import date as date_type, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import msgpack
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from bson import ObjectId
 
-from database import db, create_document, get_documents
-from schemas import Client, Staff, Service, Appointment
+from database import db, get_documents, insert_document
+from schemas import Client, Staff, Service, Appointment, AppointmentStatus, MAX_SERVICE_MINUTES
 
 
 # ---------- Utils ----------
@@ -20,41 +27,111 @@ def oid(obj) -> str:
         return obj
 
 
+def to_oid(_id: str) -> ObjectId:
+    if not ObjectId.is_valid(_id):
+        raise HTTPException(status_code=400, detail="Invalid id")
+    return ObjectId(_id)
+
+
 def serialize_doc(doc: dict) -> dict:
     if not doc:
         return doc
-    d = {**doc}
-    if d.get("_id") is not None:
-        d["id"] = str(d.pop("_id"))
-    # Convert datetimes to isoformat
-    for k, v in list(d.items()):
-        if isinstance(v, datetime):
-            d[k] = v.isoformat()
-    return d
+    # Renamed in place: every caller passes a fresh document from a query
+    _id = doc.pop("_id", None)
+    if _id is not None:
+        doc["id"] = str(_id)
+    return doc
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson response that falls back to str() for Mongo types such as ObjectId.
+
+    Endpoints return it directly so FastAPI skips its jsonable_encoder pass.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+def doc_response(doc: dict, status_code: int = 200) -> MongoJSONResponse:
+    return MongoJSONResponse(serialize_doc(doc), status_code=status_code)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    return bool(accept) and "msgpack" in accept
+
+
+def encode_response(data, accept: Optional[str], etag: Optional[str] = None) -> Response:
+    """Encode as msgpack for callers that accept it (service-to-service), JSON otherwise"""
+    headers = {"Vary": "Accept"}
+    if etag:
+        headers["ETag"] = etag
+    if wants_msgpack(accept):
+        content = msgpack.packb(data, default=_msgpack_default)
+        return Response(content, media_type="application/msgpack", headers=headers)
+    return MongoJSONResponse(data, headers=headers)
+
+
+logger = logging.getLogger(__name__)
+
+_UTC = timezone.utc
+
+# Resolved once: every db[...] lookup builds a new Motor collection wrapper
+_appointments = db["appointment"] if db is not None else None
+
+
+# ---------- Indexes ----------
+
+async def ensure_indexes():
+    # Serves has_overlap: staff equality, bounded start_time range, end_time checked from index keys
+    await _appointments.create_index([("staff_id", 1), ("start_time", 1), ("end_time", 1), ("status", 1)])
+    # Serves list_appointments date-range filter and its (start_time, _id) sort
+    await _appointments.create_index([("start_time", 1), ("_id", 1)])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if db is not None:
+        try:
+            await ensure_indexes()
+        except Exception as e:
+            logger.warning("Could not create indexes: %s", e)
+    yield
 
 
 # ---------- FastAPI App ----------
 
-app = FastAPI(title="Nail Salon Booking API")
+app = FastAPI(title="Nail Salon Booking API", default_response_class=MongoJSONResponse, lifespan=lifespan)
+
+# Comma-separated list of allowed origins; unset keeps the API open to any origin
+cors_origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=cors_origins or ["*"],
+    # Credentials are only valid with an explicit origin list, never with "*"
+    allow_credentials=bool(cors_origins),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Offset"],
 )
 
 
 # ---------- Health ----------
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Nail Salon Booking API running"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -69,7 +146,7 @@ def test_database():
         else:
             response["database"] = "✅ Connected & Working"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()
+            response["collections"] = await db.list_collection_names()
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:80]}"
     return response
@@ -98,120 +175,206 @@ class AppointmentCreate(BaseModel):
 
 
 class AppointmentStatusUpdate(BaseModel):
-    status: Optional[str] = Field(None, pattern="^(booked|canceled|completed)$")
+    status: Optional[AppointmentStatus] = None
     notes: Optional[str] = None
 
 
 # ---------- Helper logic ----------
 
-def ensure_exists(collection: str, _id: str, label: str):
-    try:
-        doc = db[collection].find_one({"_id": ObjectId(_id)})
-    except Exception:
-        doc = None
+async def ensure_exists(collection: str, _id: str, label: str, projection: Optional[dict] = None):
+    doc = await db[collection].find_one({"_id": to_oid(_id)}, projection)
     if not doc:
         raise HTTPException(status_code=404, detail=f"{label} not found")
     return doc
 
 
+# Service durations (service_id -> {"_id", "duration_minutes"}). Entries live for the
+# whole process lifetime, separately in each worker, and are never invalidated: there
+# are no service update or delete endpoints. Services edited directly in Mongo need a restart.
+_service_cache: dict = {}
+
+
+async def get_service(service_id: str) -> dict:
+    service = _service_cache.get(service_id)
+    if service is None:
+        service = await ensure_exists("service", service_id, "Service", {"duration_minutes": 1})
+        _service_cache[service_id] = service
+    return service
+
+
+@lru_cache(maxsize=64)
+def day_bounds(day: str) -> Tuple[datetime, datetime]:
+    """[start, end) of a YYYY-MM-DD day; cached since clients poll the same few days"""
+    d = date_type.fromisoformat(day)
+    start = datetime(d.year, d.month, d.day)
+    return start, start + timedelta(days=1)
+
+
+# No appointment lasts longer than the longest allowed service
+MAX_APPOINTMENT_DURATION = timedelta(minutes=MAX_SERVICE_MINUTES)
+
+
 def compute_end(start: datetime, duration_minutes: int) -> datetime:
     return start + timedelta(minutes=duration_minutes)
 
 
-def has_overlap(staff_id: str, start: datetime, end: datetime, exclude_id: Optional[str] = None) -> bool:
+async def has_overlap(staff_id: str, start: datetime, end: datetime, exclude_id: Optional[str] = None) -> bool:
     query = {
         "staff_id": staff_id,
         "status": {"$in": ["booked", "completed"]},  # completed still blocks that time historically
-        "$or": [
-            {"start_time": {"$lt": end}, "end_time": {"$gt": start}},  # core overlap condition
-        ],
+        # core overlap condition; anything ending after `start` began at most
+        # MAX_APPOINTMENT_DURATION earlier, which bounds the start_time index range
+        "start_time": {"$gte": start - MAX_APPOINTMENT_DURATION, "$lt": end},
+        "end_time": {"$gt": start},
     }
     if exclude_id:
-        query["_id"] = {"$ne": ObjectId(exclude_id)}
-    return db["appointment"].count_documents(query) > 0
+        query["_id"] = {"$ne": to_oid(exclude_id)}
+    # Only existence matters, so stop at the first blocking appointment
+    return await _appointments.find_one(query, projection={"_id": 1}) is not None
+
+
+async def collection_etag(collection: str, filter_dict: dict, accept: Optional[str]) -> str:
+    """Version tag from the matching documents' count and latest updated_at.
+
+    Derived from the data rather than a per-process counter so every worker agrees.
+    """
+    pipeline = [
+        {"$match": filter_dict},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "last": {"$max": "$updated_at"}}},
+    ]
+    stats = await db[collection].aggregate(pipeline).to_list(length=1)
+    count, last = (stats[0]["count"], stats[0]["last"]) if stats else (0, None)
+    version = int(last.replace(tzinfo=_UTC).timestamp() * 1000) if last else 0
+    fmt = "msgpack" if wants_msgpack(accept) else "json"
+    return f'"{collection}-{count}-{version:x}-{fmt}"'
+
+
+async def list_with_etag(collection: str, filter_dict: dict, accept: Optional[str], if_none_match: Optional[str]):
+    etag = await collection_etag(collection, filter_dict, accept)
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    docs = await get_documents(collection, filter_dict)
+    return encode_response([serialize_doc(d) for d in docs], accept, etag)
 
 
 # ---------- Clients ----------
 
 @app.get("/api/clients")
-def list_clients():
-    docs = get_documents("client")
-    return [serialize_doc(d) for d in docs]
+async def list_clients(accept: Optional[str] = Header(None)):
+    docs = await get_documents("client")
+    return encode_response([serialize_doc(d) for d in docs], accept)
 
 
 @app.post("/api/clients", status_code=201)
-def create_client(payload: ClientCreate):
-    new_id = create_document("client", payload)
-    doc = db["client"].find_one({"_id": ObjectId(new_id)})
-    return serialize_doc(doc)
+async def create_client(payload: ClientCreate):
+    doc = await insert_document("client", payload)
+    return doc_response(doc, status_code=201)
 
 
 # ---------- Staff ----------
 
 @app.get("/api/staff")
-def list_staff():
-    docs = get_documents("staff")
-    return [serialize_doc(d) for d in docs]
+async def list_staff(accept: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None)):
+    return await list_with_etag("staff", {}, accept, if_none_match)
 
 
 @app.post("/api/staff", status_code=201)
-def create_staff(payload: StaffCreate):
-    new_id = create_document("staff", payload)
-    doc = db["staff"].find_one({"_id": ObjectId(new_id)})
-    return serialize_doc(doc)
+async def create_staff(payload: StaffCreate):
+    doc = await insert_document("staff", payload)
+    return doc_response(doc, status_code=201)
 
 
 # ---------- Services ----------
 
 @app.get("/api/services")
-def list_services():
-    docs = get_documents("service", {"active": True})
-    return [serialize_doc(d) for d in docs]
+async def list_services(accept: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None)):
+    return await list_with_etag("service", {"active": True}, accept, if_none_match)
 
 
 @app.post("/api/services", status_code=201)
-def create_service(payload: ServiceCreate):
-    new_id = create_document("service", payload)
-    doc = db["service"].find_one({"_id": ObjectId(new_id)})
-    return serialize_doc(doc)
+async def create_service(payload: ServiceCreate):
+    doc = await insert_document("service", payload)
+    return doc_response(doc, status_code=201)
 
 
 # ---------- Appointments ----------
 
+# Fields a schedule view needs; full documents are served by GET /api/appointments/{id}
+_LIST_PROJECTION = {
+    "client_id": 1,
+    "staff_id": 1,
+    "service_id": 1,
+    "start_time": 1,
+    "end_time": 1,
+    "status": 1,
+}
+
+
 @app.get("/api/appointments")
-def list_appointments(
+async def list_appointments(
     date: Optional[str] = Query(None, description="YYYY-MM-DD to filter by day"),
     staff_id: Optional[str] = Query(None),
+    limit: int = Query(500, ge=1, le=1000, description="Maximum number of appointments to return"),
+    offset: int = Query(0, ge=0, description="Number of appointments to skip; see the X-Next-Offset header"),
+    accept: Optional[str] = Header(None),
 ):
     filt = {}
     if date:
         try:
-            day = datetime.strptime(date, "%Y-%m-%d")
+            start, end = day_bounds(date)
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid date format, expected YYYY-MM-DD")
-        start = day
-        end = day + timedelta(days=1)
         filt.update({"start_time": {"$gte": start, "$lt": end}})
     if staff_id:
         filt["staff_id"] = staff_id
-    docs = db["appointment"].find(filt).sort("start_time", 1)
-    return [serialize_doc(d) for d in docs]
+    # _id breaks start_time ties so pages are stable; one extra row tells us whether more remain
+    cursor = _appointments.find(filt, projection=_LIST_PROJECTION).sort([("start_time", 1), ("_id", 1)])
+    docs = await cursor.skip(offset).limit(limit + 1).to_list(length=None)
+    has_more = len(docs) > limit
+    response = encode_response([serialize_doc(d) for d in docs[:limit]], accept)
+    if has_more:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return response
+
+
+@app.get("/api/appointments/{appointment_id}")
+async def get_appointment(appointment_id: str):
+    doc = await ensure_exists("appointment", appointment_id, "Appointment")
+    return doc_response(doc)
 
 
 @app.post("/api/appointments", status_code=201)
-def create_appointment(payload: AppointmentCreate):
-    # Validate related entities
-    client = ensure_exists("client", payload.client_id, "Client")
-    staff = ensure_exists("staff", payload.staff_id, "Staff")
-    service = ensure_exists("service", payload.service_id, "Service")
+async def create_appointment(payload: AppointmentCreate):
+    # Validate related entities concurrently; only the service duration is needed
+    results = await asyncio.gather(
+        ensure_exists("client", payload.client_id, "Client", {"_id": 1}),
+        ensure_exists("staff", payload.staff_id, "Staff", {"_id": 1}),
+        get_service(payload.service_id),
+        return_exceptions=True,
+    )
+    # Report the first missing entity in argument order, as the sequential checks did
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    client, staff, service = results
 
     # Compute end_time from service duration
     duration = service.get("duration_minutes", 60)
+    if duration > MAX_SERVICE_MINUTES:
+        # has_overlap only looks back MAX_APPOINTMENT_DURATION; a longer booking would
+        # be invisible to later overlap checks and allow double-booking
+        logger.error("Service %s has duration %s > %s minutes", payload.service_id, duration, MAX_SERVICE_MINUTES)
+        raise HTTPException(
+            status_code=409,
+            detail=f"Service duration exceeds the maximum of {MAX_SERVICE_MINUTES} minutes",
+        )
     start_time = payload.start_time
     end_time = compute_end(start_time, duration)
 
     # Overlap check for staff schedule
-    if has_overlap(payload.staff_id, start_time, end_time):
+    if await has_overlap(payload.staff_id, start_time, end_time):
         raise HTTPException(status_code=409, detail="Time slot overlaps another appointment for this staff member")
 
     appt = Appointment(
@@ -224,14 +387,14 @@ def create_appointment(payload: AppointmentCreate):
         notes=payload.notes,
     )
 
-    new_id = create_document("appointment", appt)
-    created = db["appointment"].find_one({"_id": ObjectId(new_id)})
-    return serialize_doc(created)
+    created = await insert_document("appointment", appt)
+    return doc_response(created, status_code=201)
 
 
 @app.patch("/api/appointments/{appointment_id}")
-def update_appointment_status(appointment_id: str, payload: AppointmentStatusUpdate):
-    doc = db["appointment"].find_one({"_id": ObjectId(appointment_id)})
+async def update_appointment_status(appointment_id: str, payload: AppointmentStatusUpdate):
+    appointment_oid = to_oid(appointment_id)
+    doc = await _appointments.find_one({"_id": appointment_oid})
     if not doc:
         raise HTTPException(status_code=404, detail="Appointment not found")
 
@@ -241,21 +404,31 @@ def update_appointment_status(appointment_id: str, payload: AppointmentStatusUpd
     if payload.notes is not None:
         updates["notes"] = payload.notes
     if not updates:
-        return serialize_doc(doc)
+        return doc_response(doc)
 
-    updates["updated_at"] = datetime.utcnow()
-    db["appointment"].update_one({"_id": ObjectId(appointment_id)}, {"$set": updates})
-    doc = db["appointment"].find_one({"_id": ObjectId(appointment_id)})
-    return serialize_doc(doc)
+    updates["updated_at"] = datetime.now(_UTC)
+    await _appointments.update_one({"_id": appointment_oid}, {"$set": updates})
+    doc = await _appointments.find_one({"_id": appointment_oid})
+    return doc_response(doc)
 
 
 # Simple hello for sanity
 @app.get("/api/hello")
-def hello():
+async def hello():
     return {"message": "Hello from the nail salon backend!"}
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", 2))
+    # Workers need an import string; uvloop/httptools replace the pure-Python loop and parser
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        access_log=False,
+    )
@@ -9,19 +9,27 @@ Examples:
 - Appointment -> "appointment"
 """
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List, Literal
 from datetime import datetime
 
 
+AppointmentStatus = Literal["booked", "canceled", "completed"]
+
+# Upper bound on a service's duration; appointment overlap queries rely on it
+MAX_SERVICE_MINUTES = 480
+
+
 class Client(BaseModel):
     """
     Clients of the salon
     Collection: client
     """
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     name: str = Field(..., description="Full name of the client")
     phone: str = Field(..., description="Contact phone number")
-    email: Optional[EmailStr] = Field(None, description="Email address")
+    email: Optional[str] = Field(None, pattern=r"^[^@\s]+@[^@\s]+\.[^@\s]+$", description="Email address")
     notes: Optional[str] = Field(None, description="Additional notes about client preferences or allergies")
 
 
@@ -30,6 +38,8 @@ class Staff(BaseModel):
     Salon staff (technicians)
     Collection: staff
     """
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     name: str = Field(..., description="Staff member name")
     specialties: List[str] = Field(default_factory=list, description="List of service specialties e.g. 'Gel', 'Acrylic'")
     active: bool = Field(default=True, description="Whether the staff member is currently active")
@@ -40,9 +50,11 @@ class Service(BaseModel):
     Services offered by the salon
     Collection: service
     """
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     name: str = Field(..., description="Service name e.g. 'Gel Manicure'")
     description: Optional[str] = Field(None, description="Service description")
-    duration_minutes: int = Field(..., ge=5, le=480, description="Duration of the service in minutes")
+    duration_minutes: int = Field(..., ge=5, le=MAX_SERVICE_MINUTES, description="Duration of the service in minutes")
     price: float = Field(..., ge=0, description="Price in USD")
     active: bool = Field(default=True, description="Whether the service is available")
 
@@ -52,10 +64,12 @@ class Appointment(BaseModel):
     Appointments linking client, staff, and service
     Collection: appointment
     """
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=True)
+
     client_id: str = Field(..., description="ID of the client")
     staff_id: str = Field(..., description="ID of the staff member")
     service_id: str = Field(..., description="ID of the service")
     start_time: datetime = Field(..., description="Appointment start time (UTC or local ISO)")
     end_time: Optional[datetime] = Field(None, description="Appointment end time; computed from duration if not provided")
-    status: Literal["booked", "canceled", "completed"] = Field("booked", description="Status of appointment")
+    status: AppointmentStatus = Field("booked", description="Status of appointment")
     notes: Optional[str] = Field(None, description="Optional notes for this appointment")